@@ -1,4 +1,6 @@
 import numpy as np
+import torch
+import torch.nn.functional as F
 from medpy.filter.binary import largest_connected_component
 from skimage.exposure import rescale_intensity
 from skimage.transform import resize
@@ -83,3 +85,49 @@ def normalize_volume(volume):
     volume = (volume - m) / s
     return volume
 
+
+def _percentile(t, q):
+    k = int(round(q / 100.0 * (t.numel() - 1))) + 1
+    return t.flatten().kthvalue(k).values.item()
+
+
+def preprocess_volume(volume, mask, size=256, device="cpu"):
+    # torch version of crop_sample, pad_sample, resize_sample and normalize_volume that
+    # processes all slices of a volume at once (optionally on the GPU);
+    # returns (slices, C, size, size) volume and (slices, 1, size, size) mask arrays
+    volume = torch.from_numpy(volume).to(device).permute(0, 3, 1, 2).float()
+    mask = torch.from_numpy(mask).to(device).unsqueeze(1).gt(0).float()
+
+    def bounds(projection):
+        nonzero = torch.nonzero(projection).flatten()
+        return nonzero[0].item(), nonzero[-1].item() + 1
+
+    # crop to smallest enclosing volume
+    volume[volume < volume.max() * 0.1] = 0
+    nonzero = volume.amax(dim=1) > 0
+    z_min, z_max = bounds(nonzero.any(dim=2).any(dim=1))
+    y_min, y_max = bounds(nonzero.any(dim=2).any(dim=0))
+    x_min, x_max = bounds(nonzero.any(dim=1).any(dim=0))
+    volume = volume[z_min:z_max, :, y_min:y_max, x_min:x_max]
+    mask = mask[z_min:z_max, :, y_min:y_max, x_min:x_max]
+
+    # pad to square
+    a = volume.shape[2]
+    b = volume.shape[3]
+    diff = abs(a - b) / 2.0
+    before, after = int(np.floor(diff)), int(np.ceil(diff))
+    padding = (before, after, 0, 0) if a > b else (0, 0, before, after)
+    volume = F.pad(volume, padding)
+    mask = F.pad(mask, padding)
+
+    # resize
+    volume = F.interpolate(volume, size=(size, size), mode="bilinear", align_corners=False)
+    mask = F.interpolate(mask, size=(size, size), mode="nearest-exact")
+
+    # normalize channel-wise; clipping to the 10th/99th percentile replaces rescale_intensity,
+    # whose linear rescaling cancels out in the standardization below
+    volume = volume.clamp(_percentile(volume, 10), _percentile(volume, 99))
+    m = volume.mean(dim=(0, 2, 3), keepdim=True)
+    s = volume.std(dim=(0, 2, 3), unbiased=False, keepdim=True)
+    volume = volume.sub_(m).div_(s)
+    return volume.cpu().numpy(), mask.cpu().numpy()
@@ -14,15 +14,20 @@ import torchvision
 from torchvision import datasets, models, transforms
 
 from skimage.io import imread
+import kornia.augmentation as K
+
+# input size is fixed, so let cuDNN pick the fastest convolution algorithms once
+torch.backends.cudnn.benchmark = True
 
 exec(open('scripts/brainseg_utils.py').read())
-exec(open('scripts/brainseg_transforms.py').read())
 
 # ------------------------------------------------------------------------------
 
 train_dir = "data/kaggle_3m_train"
 valid_dir = "data/kaggle_3m_valid"
 
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
 
 # ------------------- load data ------------------------------------------------
 
@@ -48,82 +53,97 @@ class BrainSegmentationDataset(Dataset):
         transform = None,
         image_size = 256,
         random_sampling = True,
+        device = "cpu",
     ):
         volumes = {}
         masks = {}
         print("reading images...")
-        for (dirpath, dirnames, filenames) in os.walk(images_dir):
-            image_slices = []
-            mask_slices = []
-            for filename in sorted(
-                filter(lambda f: ".tif" in f, filenames),
-                key=lambda x: int(x.split(".")[-2].split("_")[4]),
-            ):
-                filepath = os.path.join(dirpath, filename)
-                if "mask" in filename:
-                    mask_slices.append(imread(filepath, as_gray=True))
-                else:
-                    image_slices.append(imread(filepath))
-            if len(image_slices) > 0:
+        dirs = [images_dir]
+        while dirs:
+            dirpath = dirs.pop()
+            entries = list(os.scandir(dirpath))
+            dirs.extend(e.path for e in entries if e.is_dir())
+            # (slice number, file name), e.g. TCGA_CS_4942_19970222_12_mask.tif -> 12
+            tif_files = sorted(
+                (int(e.name[:-4].split("_")[4]), e.name) for e in entries if e.name.endswith(".tif")
+            )
+            # first and last slice are dropped, so they are not read either
+            image_files = [os.path.join(dirpath, f) for n, f in tif_files if "mask" not in f][1:-1]
+            mask_files = [os.path.join(dirpath, f) for n, f in tif_files if "mask" in f][1:-1]
+            if len(image_files) != len(mask_files):
+                raise ValueError(
+                    "{}: found {} image slices but {} masks".format(
+                        dirpath, len(image_files), len(mask_files)
+                    )
+                )
+            if len(image_files) > 0:
+                # read slices straight into preallocated arrays instead of stacking a list;
+                # the first pair determines shape and dtype
+                image = imread(image_files[0])
+                mask = imread(mask_files[0], as_gray=True)
+                image_slices = np.empty((len(image_files),) + image.shape, dtype=image.dtype)
+                mask_slices = np.empty((len(mask_files),) + mask.shape, dtype=mask.dtype)
+                image_slices[0] = image
+                mask_slices[0] = mask
+                for i in range(1, len(image_files)):
+                    image_slices[i] = imread(image_files[i])
+                    mask_slices[i] = imread(mask_files[i], as_gray=True)
                 patient_id = dirpath.split("/")[-1]
-                volumes[patient_id] = np.array(image_slices[1:-1])
-                masks[patient_id] = np.array(mask_slices[1:-1])
+                volumes[patient_id] = image_slices
+                masks[patient_id] = mask_slices
         self.patients = sorted(volumes)
         print("preprocessing volumes...")
-        # create list of tuples (volume, mask)
-        self.volumes = [(volumes[k], masks[k]) for k in self.patients]
-        print("cropping volumes...")
-        # crop to smallest enclosing volume
-        self.volumes = [crop_sample(v) for v in self.volumes]
-        print("padding volumes...")
-        # pad to square
-        self.volumes = [pad_sample(v) for v in self.volumes]
-        print("resizing volumes...")
-        # resize
-        self.volumes = [resize_sample(v, size=image_size) for v in self.volumes]
-        print("normalizing volumes...")
-        # normalize channel-wise
-        self.volumes = [(normalize_volume(v), m) for v, m in self.volumes]
-        # probabilities for sampling slices based on masks
-        self.slice_weights = [m.sum(axis=-1).sum(axis=-1) for v, m in self.volumes]
+        # one (N, C, H, W) float32 tensor each for images and masks, allocated once in shared memory,
+        # so DataLoader workers map them instead of receiving pickled copies and a sample is a single
+        # slice read; cropping only ever drops slices, so the raw slice count bounds N
+        max_slices = sum(len(v) for v in volumes.values())
+        channels = volumes[self.patients[0]].shape[-1]
+        self.images = torch.empty(max_slices, channels, image_size, image_size).share_memory_()
+        self.masks = torch.empty(max_slices, 1, image_size, image_size).share_memory_()
+        # crop, pad to square, resize and normalize; one batched pass over all slices per patient,
+        # copied in patient by patient, so row patient_offsets[p] + s is slice s of patient p
+        self.patient_offsets = np.zeros(len(self.patients), dtype=np.int64)
+        self.slice_weights = []
+        n = 0
+        for p, k in enumerate(self.patients):
+            v, m = preprocess_volume(volumes.pop(k), masks.pop(k), size=image_size, device=device)
+            self.patient_offsets[p] = n
+            self.images[n:n + len(v)] = torch.from_numpy(v)
+            self.masks[n:n + len(m)] = torch.from_numpy(m)
+            # probabilities for sampling slices based on masks
+            self.slice_weights.append(m.sum(axis=(1, 2, 3), dtype=np.float64))
+            n += len(v)
+            del v, m
+        self.images = self.images[:n]
+        self.masks = self.masks[:n]
+        totals = [s.sum() for s in self.slice_weights]
         self.slice_weights = [
-            (s + (s.sum() * 0.1 / len(s))) / (s.sum() * 1.1) for s in self.slice_weights
+            (s + t * 0.1 / len(s)) / (t * 1.1) for s, t in zip(self.slice_weights, totals)
         ]
-        # add channel dimension to masks
-        self.volumes = [(v, m[..., np.newaxis]) for (v, m) in self.volumes]
+        # cumulative weights, so sampling a slice is a single binary search
+        self.slice_cdf = [np.cumsum(s) for s in self.slice_weights]
         print("done creating dataset")
-        # create global index for patient and slice (idx -> (p_idx, s_idx))
-        num_slices = [v.shape[0] for v, m in self.volumes]
-        self.patient_slice_index = list(
-            zip(
-                sum([[i] * num_slices[i] for i in range(len(num_slices))], []),
-                sum([list(range(x)) for x in num_slices], []),
-            )
-        )
         self.random_sampling = random_sampling
         self.transform = transform
     def __len__(self):
-        return len(self.patient_slice_index)
+        return len(self.images)
     def __getitem__(self, idx):
-        patient = self.patient_slice_index[idx][0]
-        slice_n = self.patient_slice_index[idx][1]
+        i = idx
         if self.random_sampling:
-            patient = np.random.randint(len(self.volumes))
-            slice_n = np.random.choice(
-                range(self.volumes[patient][0].shape[0]), p=self.slice_weights[patient]
-            )
-        v, m = self.volumes[patient]
-        image = v[slice_n]
-        mask = m[slice_n]
+            patient = np.random.randint(len(self.patients))
+            cdf = self.slice_cdf[patient]
+            slice_n = int(np.searchsorted(cdf, np.random.random() * cdf[-1], side="right"))
+            i = self.patient_offsets[patient] + slice_n
+        image = self.images[i]
+        mask = self.masks[i]
         if self.transform is not None:
-            image, mask = self.transform((image, mask))
-        # fix dimensions (C, H, W)
-        image = image.transpose(2, 0, 1)
-        mask = mask.transpose(2, 0, 1)
-        image_tensor = torch.from_numpy(image.astype(np.float32))
-        mask_tensor = torch.from_numpy(mask.astype(np.float32))
-        # return tensors
-        return image_tensor, mask_tensor
+            # transforms work on (H, W, C) arrays
+            image, mask = self.transform(
+                (image.numpy().transpose(1, 2, 0), mask.numpy().transpose(1, 2, 0))
+            )
+            image = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.float32))
+            mask = torch.from_numpy(np.ascontiguousarray(mask.transpose(2, 0, 1), dtype=np.float32))
+        return image, mask
 
 image_size = 256
 aug_scale = 0.05
@@ -133,14 +153,15 @@ flip_prob = 0.5
 train_ds = BrainSegmentationDataset(
         images_dir = train_dir,
         image_size = image_size,
-        transform = transforms(scale = aug_scale, angle = aug_angle, flip_prob=0.5),
-        random_sampling = True
+        random_sampling = True,
+        device = device
 )
 
 valid_ds = BrainSegmentationDataset(
         images_dir = valid_dir,
         image_size = image_size,
-        random_sampling=False
+        random_sampling=False,
+        device = device
 )
 
 batch_size = 4
@@ -150,16 +171,27 @@ train_loader = torch.utils.data.DataLoader(
         batch_size = batch_size,
         shuffle = True,
         drop_last = True,
-        num_workers = 8
+        num_workers = 8,
+        pin_memory = True,
+        persistent_workers = True,
+        prefetch_factor = 4
 )
 
 valid_loader = torch.utils.data.DataLoader(
         valid_ds,
         batch_size = batch_size,
         drop_last = False,
+        pin_memory = True
 )
 
 dataloaders = {"train": train_loader, "valid": valid_loader}
+# training batches are augmented on the GPU, in one batched pass after the host-to-device copy
+augment = K.AugmentationSequential(
+    K.RandomAffine(degrees = aug_angle, scale = (1 - aug_scale, 1 + aug_scale), p = 1.0),
+    K.RandomHorizontalFlip(p = flip_prob),
+    data_keys = ["input", "mask"]
+).to(device)
+
 image, mask = next(iter(train_loader))
 image.size()
 mask.size()
@@ -198,7 +230,6 @@ class UNet(nn.Module):
             if i != len(self.down_path) - 1:
                 blocks.append(x)
                 x = F.max_pool2d(x, 2)
-                #print("after maxpool: x is {}".format(x.size()))
         for i, up in enumerate(self.up_path):
             x = up(x, blocks[-i - 1])
         return torch.sigmoid(self.last(x))
@@ -208,11 +239,11 @@ class ConvBlock(nn.Module):
         super(ConvBlock, self).__init__()
         block = []
         block.append(nn.Conv2d(in_size, out_size, kernel_size = 3, padding = 1))
-        block.append(nn.ReLU())
+        block.append(nn.ReLU(inplace = True))
         #block.append(nn.BatchNorm2d(out_size))
         block.append(nn.Dropout(0.6))
         block.append(nn.Conv2d(out_size, out_size, kernel_size = 3, padding = 1))
-        block.append(nn.ReLU())
+        block.append(nn.ReLU(inplace = True))
         #block.append(nn.BatchNorm2d(out_size))
         block.append(nn.Dropout(0.6))
         self.block = nn.Sequential(*block)
@@ -223,16 +254,13 @@ class ConvBlock(nn.Module):
 class UpBlock(nn.Module):
     def __init__(self, in_size, out_size):
         super(UpBlock, self).__init__()
-        self.up = nn.ConvTranspose2d(in_size, out_size, kernel_size = 2, stride = 2)
-        self.conv_block = ConvBlock(in_size, out_size)
+        # upsampling is plain nearest-neighbour interpolation (no checkerboard artifacts,
+        # no transposed convolution), so the conv block sees all upsampled channels plus the bridge
+        self.conv_block = ConvBlock(in_size + out_size, out_size)
     def forward(self, x, bridge):
-        up = self.up(x)
-        #print("in upblock forward: up is {}".format(up.size()))
-        #print("in upblock forward: bridge is {}".format(bridge.size()))
+        up = F.interpolate(x, scale_factor = 2, mode = 'nearest')
         out = torch.cat([up, bridge], 1)
-        #print("in upblock forward: concatenated is {}".format(out.size()))
         out = self.conv_block(out)
-        #print("in upblock forward: out is {}".format(out.size()))
         return out
 
 class DownBlock(nn.Module):
@@ -241,14 +269,27 @@ class DownBlock(nn.Module):
         self.conv_block = ConvBlock(in_size, out_size)
     def forward(self, x):
         down = self.conv_block(x)
-        #print("in downblock forward: down is {}".format(down.size()))
         return down
 
 
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 model = UNet(depth = 5).to(device)
-
+# NHWC layout lets cuDNN use its tensor core kernels for the float16 convolutions
+model = model.to(memory_format = torch.channels_last)
+# let inductor fuse the activations and dropout into the surrounding kernels; launch overhead
+# is taken care of by the CUDA graph captured below, so inductor's own cudagraphs
+# (mode = "reduce-overhead") stay off. model itself is kept uncompiled for saving weights.
+torch.set_float32_matmul_precision('high')
+compiled_model = torch.compile(model)
+
+
+# scripted so the elementwise ops and reductions get fused instead of launched one by one
+@torch.jit.script
+def soft_dice_loss(y_pred: torch.Tensor, y_true: torch.Tensor, smooth: float) -> torch.Tensor:
+    y_pred = y_pred[:, 0]
+    y_true = y_true[:, 0]
+    intersection = (y_pred * y_true).sum()
+    dsc = (2. * intersection + smooth) / (y_pred.sum() + y_true.sum() + smooth)
+    return 1. - dsc
 
 class DiceLoss(nn.Module):
     def __init__(self):
@@ -256,19 +297,15 @@ class DiceLoss(nn.Module):
         self.smooth = 1.0
     def forward(self, y_pred, y_true):
         assert y_pred.size() == y_true.size()
-        y_pred = y_pred[:, 0].contiguous().view(-1)
-        y_true = y_true[:, 0].contiguous().view(-1)
-        intersection = (y_pred * y_true).sum()
-        dsc = (2. * intersection + self.smooth) / (
-            y_pred.sum() + y_true.sum() + self.smooth
-        )
-        return 1. - dsc
+        return soft_dice_loss(y_pred, y_true, self.smooth)
 
 
-dice_loss = DiceLoss()
+dsc_loss = DiceLoss()
 bce_loss = nn.BCELoss()
 dice_weight = 0.3
 
+num_epochs = 50
+
 optimizer = torch.optim.SGD(model.parameters(), lr = 0.1, momentum = 0.9)
 
 scheduler = torch.optim.lr_scheduler.OneCycleLR(
@@ -281,8 +318,45 @@ scheduler = torch.optim.lr_scheduler.OneCycleLR(
 best_model_wts = copy.deepcopy(model.state_dict())
 best_dice_coef = 0.0
 
-
-num_epochs = 50
+# mixed precision: convolutions run in float16 on the GPU, losses are computed in float32
+# (BCELoss is not autocast-safe, and the dice smoothing term needs the extra precision)
+use_amp = device.type == 'cuda'
+scaler = torch.amp.GradScaler('cuda', enabled = use_amp)
+
+def compute_loss(inputs, labels):
+    # the weight cast cache has to be disabled for CUDA graph capture
+    with torch.autocast(device.type, dtype = torch.float16, enabled = use_amp, cache_enabled = False):
+        preds = compiled_model(inputs)
+    preds = preds.float()
+    dice_loss = dsc_loss(preds, labels)
+    xent_loss = bce_loss(preds, labels)
+    loss = dice_weight * dice_loss + (1 - dice_weight) * xent_loss
+    return loss, dice_loss, xent_loss
+
+# Training batches always have the same shape (drop_last = True), so on the GPU we capture
+# forward and backward once as a CUDA graph and just replay it for every batch.
+# The optimizer step stays outside the graph, so the 1cycle learning rate updates still apply.
+use_cuda_graph = device.type == 'cuda'
+
+if use_cuda_graph:
+    static_inputs = image.to(device, memory_format = torch.channels_last)
+    static_labels = mask.to(device)
+    model = model.train()
+    # warm up on a side stream before capturing
+    s = torch.cuda.Stream()
+    s.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(s):
+        for i in range(3):
+            optimizer.zero_grad(set_to_none = True)
+            loss, dice_loss, xent_loss = compute_loss(static_inputs, static_labels)
+            scaler.scale(loss).backward()
+    torch.cuda.current_stream().wait_stream(s)
+    # gradients are allocated during capture and refilled by every replay
+    optimizer.zero_grad(set_to_none = True)
+    train_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(train_graph):
+        static_loss, static_dice, static_bce = compute_loss(static_inputs, static_labels)
+        scaler.scale(static_loss).backward()
 
 for epoch in range(num_epochs):
     print('Epoch {}/{}'.format(epoch, num_epochs - 1), flush = True)
@@ -297,17 +371,29 @@ for epoch in range(num_epochs):
         running_dice = 0.0
         running_bce = 0.0
         for inputs, labels in dataloaders[phase]:
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-            optimizer.zero_grad()
-            with torch.set_grad_enabled(phase == 'train'):
-                preds = model(inputs)
-                dice_loss = dsc_loss(preds, labels)
-                xent_loss = bce_loss(preds, labels)
-                loss = dice_weight * dice_loss + (1 - dice_weight) * xent_loss
-                if phase == 'train':
-                    loss.backward()
-                    optimizer.step()
+            inputs = inputs.to(device, non_blocking = True)
+            labels = labels.to(device, non_blocking = True)
+            if phase == 'train':
+                inputs, labels = augment(inputs, labels)
+            if phase == 'train' and use_cuda_graph:
+                static_inputs.copy_(inputs)
+                static_labels.copy_(labels)
+                train_graph.replay()
+                scaler.step(optimizer)
+                scaler.update()
+                loss, dice_loss, xent_loss = static_loss, static_dice, static_bce
+            elif phase == 'train':
+                inputs = inputs.contiguous(memory_format = torch.channels_last)
+                loss, dice_loss, xent_loss = compute_loss(inputs, labels)
+                optimizer.zero_grad(set_to_none = True)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                inputs = inputs.contiguous(memory_format = torch.channels_last)
+                # unlike no_grad, inference mode also skips view and version counter tracking
+                with torch.inference_mode():
+                    loss, dice_loss, xent_loss = compute_loss(inputs, labels)
             running_loss += loss.item() * inputs.size(0)
             running_dice += dice_loss.item() * inputs.size(0)
             running_bce += xent_loss.item() * inputs.size(0)